@@ -4,8 +4,20 @@ import altair as alt
 import re # Import regex for search
 from datetime import datetime # For date filtering
 import random # For study blocks
+import threading # For the shared LLM gateway
+import time
+import hashlib
+import json
+from collections import deque
+import os # For export temp files
+import tempfile
+import csv
+import html
 
 import openai
+from openpyxl import Workbook
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 # --- OpenAI API Key Configuration ---
 openai_api_key = None
@@ -19,6 +31,212 @@ except KeyError:
 except Exception as e:
     print(f"An error occurred loading OpenAI API Key: {e}") # Add print for debugging
 
+def get_secret(name, default):
+    try:
+        return st.secrets[name]
+    except Exception:
+        return default
+
+# --- Gateway LLM (compartilhado entre todas as sessões) ---
+# Requests with the same model/messages/temperature that are already in flight are merged
+# into a single upstream call; the result (or the exception) is fanned out to every waiter.
+LLM_MAX_CONCURRENCY = int(get_secret("LLM_MAX_CONCURRENCY", 4))
+LLM_TOKENS_PER_MINUTE = int(get_secret("LLM_TOKENS_PER_MINUTE", 40000))
+LLM_MAX_RETRIES = int(get_secret("LLM_MAX_RETRIES", 4))
+LLM_REQUEST_TIMEOUT = float(get_secret("LLM_REQUEST_TIMEOUT", 120)) # Seconds per upstream attempt
+LLM_COMPLETION_TOKENS_ESTIMATE = 1000 # Reserved per call, since no max_tokens is sent
+
+class LLMRequest:
+    def __init__(self, key, model, messages, temperature, estimated_tokens):
+        self.key = key
+        self.model = model
+        self.messages = messages
+        self.temperature = temperature
+        self.estimated_tokens = estimated_tokens
+        self.waiters = 1
+        self.status = "queued" # queued -> running -> (retrying) -> done
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class LLMGateway:
+    def __init__(self, client, max_concurrency, tokens_per_minute, max_retries):
+        self._client = client
+        self.max_concurrency = max(1, max_concurrency)
+        self.tokens_per_minute = max(1, tokens_per_minute)
+        self.max_retries = max(0, max_retries)
+        self._cond = threading.Condition()
+        self._inflight = {} # key -> LLMRequest (queued or running)
+        self._queue = deque() # LLMRequests waiting for a slot, FIFO
+        self._active = 0
+        self._token_log = deque() # [timestamp, tokens] of calls started in the last 60s
+
+    @staticmethod
+    def request_key(model, messages, temperature):
+        payload = json.dumps({"model": model, "messages": messages, "temperature": temperature}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def submit(self, model, messages, temperature):
+        key = self.request_key(model, messages, temperature)
+        with self._cond:
+            request = self._inflight.get(key)
+            if request is not None:
+                request.waiters += 1
+                return request
+            prompt_chars = sum(len(m.get("content", "")) for m in messages)
+            request = LLMRequest(key, model, messages, temperature, prompt_chars // 4 + LLM_COMPLETION_TOKENS_ESTIMATE)
+            self._inflight[key] = request
+            self._queue.append(request)
+        threading.Thread(target=self._run, args=(request,), daemon=True).start()
+        return request
+
+    def queue_position(self, request):
+        """1-based position in the waiting queue, or 0 if the request is no longer queued."""
+        with self._cond:
+            try:
+                return self._queue.index(request) + 1
+            except ValueError:
+                return 0
+
+    def leave(self, request):
+        """Called when a session stops waiting for the request (finished, failed or script stopped)."""
+        with self._cond:
+            request.waiters -= 1
+
+    def queue_length(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _tokens_used_last_minute(self, now):
+        while self._token_log and now - self._token_log[0][0] >= 60:
+            self._token_log.popleft()
+        return sum(tokens for _, tokens in self._token_log)
+
+    def _check_budget(self, request, now):
+        """Return (within_budget, wait timeout). Must be called with self._cond held."""
+        used = self._tokens_used_last_minute(now)
+        # An empty window always admits the request, so oversized prompts cannot starve.
+        within_budget = used == 0 or used + request.estimated_tokens <= self.tokens_per_minute
+        timeout = None
+        if not within_budget and self._token_log:
+            timeout = max(0.05, 60 - (now - self._token_log[0][0]))
+        return within_budget, timeout
+
+    def _acquire_slot(self, request):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                within_budget, timeout = self._check_budget(request, now)
+                if self._queue[0] is request and self._active < self.max_concurrency and within_budget:
+                    self._queue.popleft()
+                    self._active += 1
+                    entry = [now, request.estimated_tokens]
+                    self._token_log.append(entry)
+                    request.status = "running"
+                    self._cond.notify_all()
+                    return entry
+                self._cond.wait(timeout)
+
+    def _acquire_retry_budget(self, request):
+        """Block until the tokens-per-minute budget admits another attempt, then log it."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                within_budget, timeout = self._check_budget(request, now)
+                if within_budget:
+                    entry = [now, request.estimated_tokens]
+                    self._token_log.append(entry)
+                    self._cond.notify_all()
+                    return entry
+                self._cond.wait(timeout)
+
+    @staticmethod
+    def _retry_delay(error, attempt):
+        # Honour the server's retry-after hint when present (plus a little jitter), otherwise
+        # exponential backoff with full jitter so concurrent sessions do not retry in lockstep.
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+            try:
+                return min(60.0, float(headers[header]) * scale) + random.uniform(0, 1.0)
+            except (KeyError, TypeError, ValueError):
+                continue
+        return random.uniform(0, min(30.0, 2.0 * (2 ** attempt)))
+
+    def _call_upstream(self, request, token_entry):
+        attempt = 0
+        while True:
+            try:
+                response = self._client.chat.completions.create(
+                    model=request.model,
+                    messages=request.messages,
+                    temperature=request.temperature
+                )
+                usage = getattr(response, "usage", None)
+                if usage is not None and getattr(usage, "total_tokens", None):
+                    with self._cond:
+                        token_entry[1] = usage.total_tokens
+                        self._cond.notify_all()
+                return response.choices[0].message.content
+            except (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError) as e:
+                if attempt >= self.max_retries:
+                    raise
+                request.status = "retrying"
+                time.sleep(self._retry_delay(e, attempt))
+                attempt += 1
+                token_entry = self._acquire_retry_budget(request) # Retries wait for budget like first attempts
+                request.status = "running"
+
+    def _run(self, request):
+        token_entry = self._acquire_slot(request)
+        try:
+            request.result = self._call_upstream(request, token_entry)
+        except Exception as e:
+            request.error = e
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._inflight.pop(request.key, None)
+                request.status = "done"
+                self._cond.notify_all()
+            request.done.set()
+
+@st.cache_resource
+def get_llm_gateway():
+    # Dedicated client with SDK retries disabled: the gateway is the only retry/backoff layer.
+    client = openai.OpenAI(api_key=openai_api_key, max_retries=0, timeout=LLM_REQUEST_TIMEOUT)
+    return LLMGateway(client, LLM_MAX_CONCURRENCY, LLM_TOKENS_PER_MINUTE, LLM_MAX_RETRIES)
+
+def call_llm(prompt, temperature, model="gpt-4"):
+    """Send a prompt through the shared gateway, showing queue status while waiting.
+
+    Returns the generated text; re-raises the upstream OpenAI exception on failure.
+    """
+    gateway = get_llm_gateway()
+    request = gateway.submit(model, [{"role": "user", "content": prompt}], temperature)
+    status_placeholder = st.empty()
+    try: # finally also runs when a rerun stops this script, so stale sessions are not counted
+        while not request.done.wait(0.5):
+            position = gateway.queue_position(request)
+            if position:
+                status = f"⏳ Na fila da IA: posição {position} de {gateway.queue_length()}."
+            elif request.status == "retrying":
+                status = "⏳ Limite de taxa da API atingido. Tentando novamente em instantes..."
+            else:
+                status = "⚙️ Processando sua solicitação..."
+            if request.waiters > 1:
+                status += f" ({request.waiters} sessões aguardando esta resposta)"
+            status_placeholder.caption(status)
+    finally:
+        gateway.leave(request)
+    status_placeholder.empty()
+    if request.error is not None:
+        # Each coalesced session raises its own copy, so they don't share one __traceback__.
+        error = type(request.error).__new__(type(request.error))
+        error.__dict__.update(request.error.__dict__)
+        error.args = request.error.args
+        raise error from request.error
+    return request.result
+
 # Configuração inicial da página
 st.set_page_config(
     page_title="Informativos STF | Mentoria de Resultado",
@@ -40,6 +258,8 @@ if 'show_caso_pratico_dialog' not in st.session_state:
     st.session_state.show_caso_pratico_dialog = False
 if 'favorites' not in st.session_state:
     st.session_state.favorites = set()
+if 'ai_material_cache' not in st.session_state: # AI texts kept for exports: {julgado_id: {coluna: texto}}
+    st.session_state.ai_material_cache = {}
 if 'selected_meta_julgado_id' not in st.session_state: # For clickable study blocks
     st.session_state.selected_meta_julgado_id = None
 if 'current_study_meta_ids' not in st.session_state: # Store current meta list
@@ -252,6 +472,159 @@ def render_table(df):
         df_display['Data'] = df_display['Data'].dt.strftime('%d/%m/%Y')
     st.dataframe(df_display, use_container_width=True)
 
+# --- Exportação de Julgados ---
+# Exports are written chunk by chunk to a temp file, so building the file only holds EXPORT_CHUNK_SIZE
+# julgados in memory at a time. The finished file is then handed once to st.download_button, which keeps
+# its bytes in Streamlit's in-memory media store until the button is no longer rendered; the temp file
+# itself is deleted right after that.
+EXPORT_CHUNK_SIZE = 500
+EXPORT_COLUMNS = {
+    'id': 'ID',
+    'numero_informativo': 'Informativo',
+    'data': 'Data',
+    'Título': 'Título',
+    'classe_processo': 'Classe',
+    'ramos_direito': 'Ramos do Direito',
+    'areas_estudo': 'Áreas de Estudo',
+    'repercussao_geral': 'Repercussão Geral',
+    'tese_julgamento': 'Tese / Notícia',
+    'Resumo': 'Resumo',
+    'Legislação': 'Legislação',
+    'caso_pratico_ia': 'Caso Prático (IA)',
+    'assertivas_ia': 'Assertivas (IA)'
+}
+EXPORT_FORMATS = {
+    'CSV': ('.csv', 'text/csv'),
+    'Excel (XLSX)': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'Parquet': ('.parquet', 'application/octet-stream'),
+    'Anki (TXT para importação)': ('.txt', 'text/plain')
+}
+
+def cache_ai_material(julgado_id, column, text):
+    st.session_state.ai_material_cache.setdefault(julgado_id, {})[column] = text
+
+def get_cached_ai_material(julgado_ids):
+    """Collect the AI texts generated in this session (caso prático/assertivas) for the given IDs."""
+    cache = st.session_state.ai_material_cache
+    return {julgado_id: cache[julgado_id] for julgado_id in julgado_ids if julgado_id in cache}
+
+def iter_export_chunks(julgado_ids, ai_material, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield DataFrames with one row per julgado (ramos/areas joined), in the order of julgado_ids.
+
+    'data' is a datetime column and 'numero_informativo' an Int64 column; everything else is text.
+    """
+    for start in range(0, len(julgado_ids), chunk_size):
+        chunk_ids = julgado_ids[start:start + chunk_size]
+        df_chunk = df_informativos_exploded[df_informativos_exploded['id'].isin(chunk_ids)]
+        joined = df_chunk.groupby('id', sort=False).agg(
+            ramos_direito=('ramo_direito', lambda s: '; '.join(s.dropna().unique())),
+            areas_estudo=('area_estudo', lambda s: '; '.join(s.dropna().unique()))
+        )
+        rows = df_chunk.drop_duplicates(subset=['id']).set_index('id').join(joined).reindex(chunk_ids).rename_axis('id').reset_index()
+        rows['data'] = rows['data_julgamento'].dt.normalize()
+        rows['numero_informativo'] = pd.to_numeric(rows['numero_informativo'], errors='coerce').astype('Int64')
+        for col in ['caso_pratico_ia', 'assertivas_ia']:
+            rows[col] = rows['id'].map(lambda julgado_id: ai_material.get(julgado_id, {}).get(col, ''))
+        text_cols = [col for col in EXPORT_COLUMNS if col not in ('data', 'numero_informativo')]
+        rows[text_cols] = rows[text_cols].fillna('').astype(str)
+        yield rows[list(EXPORT_COLUMNS.keys())]
+
+def export_chunk_as_text(chunk):
+    """All columns as text (CSV/Anki)."""
+    chunk = chunk.copy()
+    chunk['data'] = chunk['data'].dt.strftime('%Y-%m-%d').fillna('')
+    chunk['numero_informativo'] = chunk['numero_informativo'].astype('string').fillna('')
+    return chunk
+
+def export_chunk_as_native(chunk):
+    """Dates as datetime.date, informativo as int and missing values as None (XLSX/Parquet)."""
+    chunk = chunk.copy()
+    chunk['data'] = chunk['data'].dt.date
+    return chunk.astype(object).where(chunk.notna(), None)
+
+def to_anki_html(text):
+    return html.escape(text).replace('\t', ' ').replace('\r\n', '<br>').replace('\n', '<br>')
+
+def write_export(path, export_format, julgado_ids, ai_material, on_progress=None):
+    total = len(julgado_ids)
+    written = 0
+    chunks = iter_export_chunks(julgado_ids, ai_material)
+    if export_format == 'CSV':
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f: # BOM so Excel detects UTF-8
+            for i, chunk in enumerate(chunks):
+                export_chunk_as_text(chunk).rename(columns=EXPORT_COLUMNS).to_csv(f, header=(i == 0), index=False)
+                written += len(chunk)
+                if on_progress: on_progress(written, total)
+    elif export_format == 'Excel (XLSX)':
+        wb = Workbook(write_only=True) # Rows are flushed to disk instead of kept in memory
+        ws = wb.create_sheet("Julgados")
+        ws.append(list(EXPORT_COLUMNS.values()))
+        for chunk in chunks:
+            for row in export_chunk_as_native(chunk).itertuples(index=False):
+                ws.append(list(row))
+            written += len(chunk)
+            if on_progress: on_progress(written, total)
+        wb.save(path)
+    elif export_format == 'Parquet':
+        column_types = {'data': pa.date32(), 'numero_informativo': pa.int64()}
+        schema = pa.schema([(name, column_types.get(col, pa.string())) for col, name in EXPORT_COLUMNS.items()])
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(export_chunk_as_native(chunk).rename(columns=EXPORT_COLUMNS), schema=schema, preserve_index=False))
+                written += len(chunk)
+                if on_progress: on_progress(written, total)
+    elif export_format == 'Anki (TXT para importação)':
+        # Anki's plain-text import format: Frente / Verso / Tags, HTML enabled.
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write("#separator:tab\n#html:true\n#tags column:3\n")
+            writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+            for chunk in chunks:
+                for row in export_chunk_as_text(chunk).to_dict('records'):
+                    frente = f"{to_anki_html(row['Título'])}<br><small>Inf. {row['numero_informativo']} - {row['data']}</small>"
+                    verso = to_anki_html(row['tese_julgamento'] or row['Resumo']) # Most julgados have no tese, only a resumo
+                    if row['ramos_direito']:
+                        verso += f"<br><br><b>Ramo(s) do Direito:</b> {to_anki_html(row['ramos_direito'])}"
+                    if row['caso_pratico_ia']:
+                        verso += f"<br><br><b>Caso Prático (IA):</b><br>{to_anki_html(row['caso_pratico_ia'])}"
+                    if row['assertivas_ia']:
+                        verso += f"<br><br><b>Assertivas (IA):</b><br>{to_anki_html(row['assertivas_ia'])}"
+                    tags = ' '.join(['STF'] + [ramo.strip().replace(' ', '_') for ramo in row['ramos_direito'].split(';') if ramo.strip()])
+                    writer.writerow([frente, verso, tags])
+                written += len(chunk)
+                if on_progress: on_progress(written, total)
+    else:
+        raise ValueError(f"Formato de exportação desconhecido: {export_format}")
+
+def render_export_section(scopes):
+    """Export UI. `scopes` maps a label to the list of julgado IDs it covers."""
+    with st.expander("📥 Exportar Julgados"):
+        scope_label = st.radio("Julgados para exportar:", list(scopes.keys()), horizontal=True, key="export_scope")
+        export_format = st.selectbox("Formato:", list(EXPORT_FORMATS.keys()), key="export_format")
+        julgado_ids = scopes[scope_label]
+        st.caption(f"{len(julgado_ids)} julgados únicos serão exportados (uma linha por julgado, com ramos/áreas agrupados e os casos práticos e assertivas gerados pela IA nesta sessão).")
+        if not julgado_ids:
+            st.info("Nenhum julgado disponível para exportação nesta seleção.")
+            return
+        # The download button is only rendered in the run that generated the file, so the bytes are not
+        # re-registered on every rerun; on_click="ignore" keeps the click from triggering a rerun.
+        if st.button("Gerar Arquivo de Exportação", key="export_gen"):
+            suffix, mime = EXPORT_FORMATS[export_format]
+            fd, path = tempfile.mkstemp(prefix="informativos_stf_", suffix=suffix)
+            os.close(fd)
+            progress_bar = st.progress(0.0, text="Exportando julgados...")
+            try:
+                write_export(path, export_format, julgado_ids, get_cached_ai_material(julgado_ids),
+                             on_progress=lambda done, total: progress_bar.progress(done / total, text=f"Exportando julgados... {done}/{total}"))
+                progress_bar.empty()
+                with open(path, 'rb') as f:
+                    st.download_button(f"Baixar Arquivo ({export_format})", data=f, file_name=f"informativos_stf_{datetime.now().strftime('%Y%m%d_%H%M')}{suffix}", mime=mime, key="export_download", on_click="ignore")
+            except Exception as e:
+                progress_bar.empty()
+                st.error(f"Erro ao exportar os julgados: {e}")
+            finally: # Also runs on Streamlit's rerun/stop exceptions, so no temp file is left behind
+                if os.path.exists(path):
+                    os.remove(path)
+
 # --- Carregar Dados ---
 data_path = "Dados_InformativosSTF_2021-2025.xlsx" # Use the filtered Excel file path
 df_informativos_exploded = load_data(data_path)
@@ -364,12 +737,8 @@ if df_informativos_exploded is not None:
                                 [Pergunta clara sobre a aplicação do julgado STF ao caso]
                                 """
 
-                                response = openai.chat.completions.create(
-                                    model="gpt-4",
-                                    messages=[{"role": "user", "content": prompt}],
-                                    temperature=0.7 # More creative for case studies
-                                )
-                                st.session_state[session_key_caso] = response.choices[0].message.content
+                                st.session_state[session_key_caso] = call_llm(prompt, temperature=0.7) # More creative for case studies
+                                cache_ai_material(st.session_state.selected_julgado_id_caso, 'caso_pratico_ia', st.session_state[session_key_caso]) # Survives closing the dialog
                             except openai.AuthenticationError:
                                  st.error("Erro de autenticação com a API OpenAI. Verifique se sua chave de API está correta e configurada nos segredos do Streamlit.")
                                  st.session_state[session_key_caso] = "ERROR" # Mark as error to prevent retry loop
@@ -422,6 +791,13 @@ if df_informativos_exploded is not None:
             else:
                 st.info("Nenhum informativo encontrado com os filtros e busca aplicados.")
 
+        # --- Exportação ---
+        render_export_section({
+            "Resultados filtrados/buscados": df_final_filtered['id'].drop_duplicates().tolist(),
+            "Favoritos": df_informativos_exploded[df_informativos_exploded['id'].isin(st.session_state.favorites)]['id'].drop_duplicates().tolist(),
+            "Meta de Estudo atual": list(st.session_state.current_study_meta_ids)
+        })
+
     with tab2:
         st.header("Estatísticas Gerais")
         st.write(f"Visualizações sobre os {df_filtered_sidebar['id'].nunique()} julgados únicos ({len(df_filtered_sidebar)} linhas/ramos) filtrados pela barra lateral.")
@@ -516,13 +892,8 @@ if df_informativos_exploded is not None:
                                **Justificativa:** [Breve justificativa 5]
                             """
 
-                            response = openai.chat.completions.create(
-                                model="gpt-4", # Use GPT-4 as requested
-                                messages=[{"role": "user", "content": prompt}],
-                                temperature=0.5 # Slightly creative but mostly factual
-                            )
-
-                            resposta_texto = response.choices[0].message.content
+                            resposta_texto = call_llm(prompt, temperature=0.5) # Slightly creative but mostly factual
+                            cache_ai_material(st.session_state.selected_julgado_id_assertiva, 'assertivas_ia', resposta_texto) # Kept for exports
                             st.markdown("---")
                             st.markdown("**Assertivas Geradas (GPT-4):**")
                             st.markdown(resposta_texto) # Display the raw response formatted by the prompt
@@ -576,12 +947,7 @@ if df_informativos_exploded is not None:
                         4. Não invente informações nem faça suposições.
                         """
 
-                        response = openai.chat.completions.create(
-                            model="gpt-4",
-                            messages=[{"role": "user", "content": prompt}],
-                            temperature=0.2 # Low temperature for factual answers based on context
-                        )
-                        resposta_texto = response.choices[0].message.content
+                        resposta_texto = call_llm(prompt, temperature=0.2) # Low temperature for factual answers based on context
                         st.markdown("---")
                         st.markdown("**Resposta (GPT-4):**")
                         st.markdown(resposta_texto)